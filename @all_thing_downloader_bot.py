@@ -4,20 +4,42 @@
 # - Совместим с Python 3.14 (явно создаём event loop).
 # - Увеличены таймауты HTTP-клиента для стабильной отправки файлов в Telegram.
 # - Если ffmpeg не в PATH — можно указать FFMPEG_LOCATION.
+# - Для файлов больше 50 МБ запусти рядом локальный Bot API сервер:
+#     telegram-bot-api --local --api-id=<id> --api-hash=<hash> --http-port=8081
+#   и задай TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot (лимит аплоада — 2 ГБ).
+#   Бот работает с ним в local mode: серверу передаётся только путь к файлу,
+#   поэтому сервер должен видеть ту же файловую систему (тот же хост/volume,
+#   включая DOWNLOAD_TMPDIR и /dev/shm).
+# - Большие файлы можно слать через MTProto: pip install pyrogram tgcrypto
+#   и задай TELEGRAM_API_ID / TELEGRAM_API_HASH (https://my.telegram.org).
 
 from __future__ import annotations
 
+import io
+import json
 import os
 import re
+import glob
+import shutil
 import sys
 import asyncio
 import tempfile
 import logging
+import logging.handlers
+import mmap
 import secrets
+import socket
+import functools
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from queue import SimpleQueue
 from urllib.parse import urlparse
 
+import httpx
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError, ExtractorError
 from telegram import (
     Update,
     InputFile,
@@ -43,12 +65,30 @@ import os
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 if not TELEGRAM_TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN is not set")
+
+# Локальный Bot API сервер (telegram-bot-api --local), например http://127.0.0.1:8081/bot
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
+TELEGRAM_BASE_FILE_URL = os.getenv("TELEGRAM_BASE_FILE_URL")
+if TELEGRAM_BASE_URL and not TELEGRAM_BASE_FILE_URL:
+    TELEGRAM_BASE_FILE_URL = re.sub(r"/bot$", "/file/bot", TELEGRAM_BASE_URL)
+
+# MTProto (pyrogram) для отправки больших файлов — необязательно
+TELEGRAM_API_ID = os.getenv("TELEGRAM_API_ID")
+TELEGRAM_API_HASH = os.getenv("TELEGRAM_API_HASH")
 # ==============================
 
 # Если ffmpeg НЕ в PATH — пропиши путь к папке с ffmpeg/ffprobe:
 FFMPEG_LOCATION: str | None = None  # Например: r"C:\ffmpeg\ffmpeg-2025-xx-xx-full_build\bin"
 
-logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+# Пишет в stderr отдельный поток: logger.* в хендлерах только кладёт запись в очередь
+# и не блокирует event loop, если stderr — медленный pipe (journald и т.п.)
+_log_queue: SimpleQueue = SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
+log_listener.start()
 logger = logging.getLogger("downloader_bot")
 
 BASE_YTDLP_OPTS: dict = {
@@ -56,102 +96,586 @@ BASE_YTDLP_OPTS: dict = {
     "quiet": True,
     "no_warnings": True,
     "merge_output_format": "mp4",
-    "postprocessors": [{"key": "FFmpegVideoConvertor", "preferedformat": "mp4"}],
+    # плейлисты не разворачиваем: из ссылки вида watch?v=…&list=… берём только видео,
+    # а из чистого плейлиста — один первый элемент
+    "noplaylist": True,
+    "playlist_items": "1",
+    # Remuxer только перепаковывает потоки (-c copy) и пропускает файлы, уже лежащие в mp4;
+    # Convertor перекодировал бы webm/mkv целиком
+    "postprocessors": [{"key": "FFmpegVideoRemuxer", "preferedformat": "mp4"}],
 }
 if FFMPEG_LOCATION:
     BASE_YTDLP_OPTS["ffmpeg_location"] = FFMPEG_LOCATION
 
-URL_RE = re.compile(r"(https?://[^\s]+)", re.IGNORECASE | re.MULTILINE)
+# Для анализа нужны только title и formats[].height: ничего не качаем,
+# плейлисты не разворачиваем, у YouTube пропускаем лишние запросы
+ANALYZE_YTDLP_OPTS: dict = {
+    **{k: v for k, v in BASE_YTDLP_OPTS.items() if k != "postprocessors"},
+    "skip_download": True,
+    "extract_flat": "in_playlist",
+    "extractor_args": {"youtube": {"player_skip": ["webpage", "configs"]}},
+}
+
+# Сколько секунд info из анализа можно переиспользовать для скачивания
+# (подписанные ссылки на форматы со временем протухают)
+INFO_TTL = 10 * 60
+
+# Отдельный пул потоков под yt-dlp, чтобы медленное извлечение у одного
+# пользователя не занимало дефолтный executor asyncio
+YDL_WORKERS = 8
+YDL_PER_USER = 2  # сколько задач yt-dlp один пользователь может держать одновременно
+YDL_EXECUTOR = ThreadPoolExecutor(max_workers=YDL_WORKERS, thread_name_prefix="ydl")
+
+# Клипы до этого размера качаем сразу в память и отправляем, минуя диск
+STREAM_MAX_BYTES = 20 * 1024 * 1024
+
+# Без IGNORECASE/MULTILINE: ^/$ в шаблоне нет, а регистр схемы (Https:// после
+# автозамены на телефоне) покрыт классами символов
+URL_RE = re.compile(r"[Hh][Tt][Tt][Pp][Ss]?://\S+")
+
+# Один проход регуляркой по хосту вместо цепочки проверок `in`
+_PROVIDER_RE = re.compile(r"instagram|tiktok|youtube|youtu\.be|twitter|(?:^|\.)x\.com$|vk\.com|reddit")
+_PROVIDER_NAMES = {
+    "instagram": "Instagram",
+    "tiktok": "TikTok",
+    "youtube": "YouTube",
+    "youtu.be": "YouTube",
+    "twitter": "X (Twitter)",
+    "x.com": "X (Twitter)",
+    "vk.com": "VK",
+    "reddit": "Reddit",
+}
 
 # =================== Утилиты ===================
 
 def extract_first_url(text: str) -> str | None:
-    if not text:
+    # быстрый выход для обычных сообщений без ссылок
+    if not text or "://" not in text:
         return None
     m = URL_RE.search(text)
-    return m.group(1) if m else None
+    return m.group(0) if m else None
 
+# URL — неизменяемые строки, так что разбор можно спокойно мемоизировать
+@functools.lru_cache(maxsize=2048)
 def hostname(url: str) -> str:
     try:
         return (urlparse(url).hostname or "").lower()
     except Exception:
         return ""
 
+@functools.lru_cache(maxsize=2048)
 def human_provider(url: str) -> str:
     host = hostname(url)
-    if "instagram" in host:
-        return "Instagram"
-    if "tiktok" in host:
-        return "TikTok"
-    if host in {"youtu.be", "youtube.com", "www.youtube.com", "m.youtube.com"} or "youtube" in host:
-        return "YouTube"
-    if "twitter" in host or host == "x.com":
-        return "X (Twitter)"
-    if "vk.com" in host:
-        return "VK"
-    if "reddit" in host:
-        return "Reddit"
+    m = _PROVIDER_RE.search(host)
+    if m:
+        return _PROVIDER_NAMES[m.group(0).lstrip(".")]
     return host or "Источник"
 
-def pick_filename_from_dir(target_dir: Path, media_id: str | None) -> Path | None:
-    files = list(target_dir.iterdir())
-    if not files:
-        return None
+def downloaded_file_path(info: dict, target_dir: Path) -> Path | None:
+    """Итоговый путь yt-dlp сам кладёт в requested_downloads — папку не сканируем."""
+    for d in info.get("requested_downloads") or []:
+        if d.get("filepath") and Path(d["filepath"]).exists():
+            return Path(d["filepath"])
+    if info.get("_filename") and Path(info["_filename"]).exists():
+        return Path(info["_filename"])
+    media_id = info.get("id") or info.get("display_id")
     if media_id:
-        for p in files:
-            if media_id in p.name:
-                return p
-    return files[0]
+        return next(target_dir.glob(f"{glob.escape(media_id)}.*"), None)
+    return None
 
 def build_format_string(height: int | None) -> str:
     if not height:
         return "bestvideo*+bestaudio/best"
     return f"bestvideo*[height<=?{height}]+bestaudio/best[height<=?{height}]"
 
+def pick_format_ids(formats: list[dict], height: int | None) -> str | None:
+    """Лучшее видео <= height + лучший звук (или цельный формат), как строка "137+140"."""
+    def fits(f: dict) -> bool:
+        return not f.get("has_drm") and (not height or (f.get("height") or 0) <= height)
+
+    video = [
+        f for f in formats
+        if fits(f) and f.get("vcodec") not in (None, "none") and f.get("acodec") == "none" and f.get("height")
+    ]
+    audio = [f for f in formats if not f.get("has_drm") and f.get("acodec") not in (None, "none") and f.get("vcodec") == "none"]
+    muxed = [f for f in formats if fits(f) and f.get("vcodec") != "none" and f.get("acodec") != "none"]
+
+    def by_quality(f: dict) -> tuple:
+        return f.get("height") or 0, f.get("tbr") or 0
+
+    def by_audio_quality(f: dict) -> tuple:
+        # как сортировка yt-dlp: сначала приоритеты экстрактора и язык (оригинальная
+        # дорожка, а не дубляж/автоперевод), и только потом битрейт
+        return (
+            f.get("preference") or 0,
+            f.get("language_preference") if f.get("language_preference") is not None else -1,
+            f.get("quality") or 0,
+            f.get("abr") or f.get("tbr") or 0,
+            f.get("source_preference") or 0,
+        )
+
+    best_muxed = max(muxed, key=by_quality) if muxed else None
+    if video and audio:
+        v = max(video, key=by_quality)
+        a = max(audio, key=by_audio_quality)
+        if not best_muxed or v["height"] >= (best_muxed.get("height") or 0):
+            return f"{v['format_id']}+{a['format_id']}"
+    return best_muxed["format_id"] if best_muxed else None
+
+def pick_stream_format(info: dict, height: int | None) -> dict | None:
+    """Цельный (видео+звук) mp4 по прямой http-ссылке, который не хуже того, что выбрал бы yt-dlp."""
+    formats = info.get("formats") or []
+    fits = [
+        f for f in formats
+        if f.get("vcodec") != "none" and (not height or (f.get("height") or 0) <= height)
+    ]
+    if not fits:
+        return None
+    best_height = max(f.get("height") or 0 for f in fits)
+    best = None
+    for f in fits:
+        if f.get("acodec") == "none" or f.get("ext") != "mp4" or f.get("protocol") not in ("http", "https"):
+            continue
+        if (f.get("height") or 0) < best_height:
+            continue
+        size = f.get("filesize") or f.get("filesize_approx")
+        if size and size > STREAM_MAX_BYTES:
+            continue
+        if best is None or (f.get("tbr") or 0) > (best.get("tbr") or 0):
+            best = f
+    return best
+
+def _remember_cookie_headers(ydl: YoutubeDL, info: dict) -> None:
+    # yt-dlp убирает Cookie из http_headers, а сессионные куки (TikTok) живут только в его
+    # cookiejar — сохраняем готовый заголовок для прямого скачивания в память
+    for f in info.get("formats") or []:
+        if f.get("protocol") in ("http", "https") and f.get("url"):
+            cookie = ydl.cookiejar.get_cookie_header(f["url"])
+            if cookie:
+                f["_cookie_header"] = cookie
+
+async def fetch_to_memory(fmt: dict) -> bytes | None:
+    """Качает формат в память; None, если файл оказался больше STREAM_MAX_BYTES."""
+    headers = dict(fmt.get("http_headers") or {})
+    if fmt.get("_cookie_header"):
+        headers["Cookie"] = fmt["_cookie_header"]
+    buf = bytearray()
+    async with httpx.AsyncClient(follow_redirects=True, timeout=30.0) as client:
+        async with client.stream("GET", fmt["url"], headers=headers) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_bytes():
+                buf += chunk
+                if len(buf) > STREAM_MAX_BYTES:
+                    return None
+    return bytes(buf)
+
+def single_entry(info: dict) -> dict:
+    """Для ссылки на плейлист yt-dlp вернёт обёртку с одним элементом (playlist_items=1)."""
+    entries = info.get("entries")
+    if isinstance(entries, list) and entries:
+        return entries[0]
+    return info
+
+# Тяжёлые поля info, которые скачиванию по сохранённому info не нужны
+# (у YouTube субтитры и автоперевод к ним — сотни КБ на ссылку)
+UNUSED_INFO_KEYS = (
+    "automatic_captions", "subtitles", "thumbnails", "heatmap",
+    "description", "chapters", "comments",
+)
+
+def slim_info(info: dict) -> dict:
+    return {k: v for k, v in info.items() if k not in UNUSED_INFO_KEYS}
+
 def unique_sorted_heights(formats: list[dict]) -> list[int]:
     heights = {f.get("height") for f in formats if isinstance(f.get("height"), int)}
     heights = [h for h in heights if h and h >= 240]
     heights.sort()
     return heights
 
-async def ytdlp_extract(url: str, download: bool, fmt: str | None, target_dir: Path) -> dict | None:
+async def ytdlp_extract(
+    url: str,
+    download: bool,
+    fmt: str | None,
+    target_dir: Path | None,
+    info: dict | None = None,
+    base_opts: dict = BASE_YTDLP_OPTS,
+) -> dict | None:
+    """Если передан info из анализа — качаем по нему (process_ie_result), не дёргая сайт повторно."""
     loop = asyncio.get_running_loop()
 
     def run_ydl():
-        opts = dict(BASE_YTDLP_OPTS)
+        opts = dict(base_opts)
         if fmt:
             opts["format"] = fmt
-        cwd = os.getcwd()
-        try:
-            os.chdir(target_dir)
-            with YoutubeDL(opts) as ydl:
-                return ydl.extract_info(url, download=download)
-        finally:
-            os.chdir(cwd)
+        # Каталог задаём через paths/outtmpl, а не os.chdir: cwd общий на процесс,
+        # и параллельные скачивания разных пользователей путали бы папки
+        if target_dir is not None:
+            opts["paths"] = {"home": str(target_dir)}
+            opts["outtmpl"] = str(target_dir / BASE_YTDLP_OPTS["outtmpl"])
+        with YoutubeDL(opts) as ydl:
+            if info is not None:
+                return ydl.process_ie_result(info, download=download)
+            result = ydl.extract_info(url, download=download)
+            if result and not download:
+                # extract_flat="in_playlist": для голой ссылки на плейлист первый элемент —
+                # заглушка _type=url без форматов; разрешаем только её, а не весь плейлист
+                entry = single_entry(result)
+                if entry.get("_type") in ("url", "url_transparent"):
+                    entry = ydl.process_ie_result(entry, download=False)
+                    # обёртку плейлиста сохраняем: по ней handle_text предупреждает пользователя
+                    result = {**result, "entries": [entry]} if result.get("entries") else entry
+                _remember_cookie_headers(ydl, single_entry(result))
+            return result
+
+    return await loop.run_in_executor(YDL_EXECUTOR, run_ydl)
+
+def user_ydl_slot(user_data: dict) -> asyncio.Semaphore:
+    sem = user_data.get("ydl_slot")
+    if sem is None:
+        sem = user_data["ydl_slot"] = asyncio.Semaphore(YDL_PER_USER)
+    return sem
+
+# =================== MTProto (pyrogram, опционально) ===================
+
+PYRO_MIN_SIZE = 10 * 1024 * 1024  # мелкие файлы быстрее отправить через Bot API
+pyro_client = None  # pyrogram.Client, запускается в on_startup
+
+def build_pyro_client():
+    if not (TELEGRAM_API_ID and TELEGRAM_API_HASH):
+        return None
+    try:
+        # импорт лениво: pyrogram при импорте дёргает asyncio.get_event_loop()
+        from pyrogram import Client
+    except ImportError:
+        logger.warning("TELEGRAM_API_ID задан, но pyrogram не установлен — отправляю через Bot API")
+        return None
+    return Client(
+        "downloader_bot",
+        api_id=int(TELEGRAM_API_ID),
+        api_hash=TELEGRAM_API_HASH,
+        bot_token=TELEGRAM_TOKEN,
+        in_memory=True,
+        no_updates=True,
+    )
+
+# Потоковая заливка: stdout yt-dlp режем на части по 512 КБ и отправляем
+# upload.saveBigFilePart параллельно, не дожидаясь конца скачивания
+MTPROTO_PART_SIZE = 512 * 1024
+MTPROTO_PARALLEL_PARTS = 4
+
+def _ytdlp_stdout_cmd(url: str, fmt: str, info_json: Path | None) -> list[str]:
+    cmd = [
+        sys.executable, "-m", "yt_dlp",
+        "--quiet", "--no-warnings", "--no-playlist", "--playlist-items", "1",
+        "-f", fmt, "-o", "-",
+        # Любой протокол — через ffmpeg: иначе одиночный формат (hls, webm, flv) ушёл бы в stdout
+        # как есть. В stdout yt-dlp выбрал бы mpegts; фрагментированный mp4 Telegram показывает как видео
+        "--downloader", "ffmpeg",
+        "--downloader-args", "ffmpeg_o:-f mp4 -movflags +frag_keyframe+empty_moov",
+    ]
+    if FFMPEG_LOCATION:
+        cmd += ["--ffmpeg-location", FFMPEG_LOCATION]
+    if info_json:
+        return cmd + ["--load-info-json", str(info_json)]
+    return cmd + [url]
+
+async def _read_part(stream: asyncio.StreamReader) -> bytes:
+    try:
+        return await stream.readexactly(MTPROTO_PART_SIZE)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
 
-    return await loop.run_in_executor(None, run_ydl)
+async def stream_to_mtproto(
+    message,
+    url: str,
+    fmt: str,
+    info: dict | None,
+    work_dir: Path,
+    caption: str,
+) -> bytes | None:
+    """Качает yt-dlp в stdout и по ходу заливает части в Telegram через MTProto.
+
+    Если файл оказался меньше PYRO_MIN_SIZE, ничего не отправляет и возвращает его
+    содержимое — такой файл дешевле отправить через Bot API. Иначе возвращает None.
+    """
+    from pyrogram import raw
+
+    info_json = None
+    if info:
+        # свежий info из анализа — yt-dlp в подпроцессе не пойдёт на сайт повторно
+        info_json = work_dir / "info.json"
+        info_json.write_text(json.dumps(YoutubeDL.sanitize_info(info)), encoding="utf-8")
+
+    proc = await asyncio.create_subprocess_exec(
+        *_ytdlp_stdout_cmd(url, fmt, info_json),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stderr_task = asyncio.create_task(proc.stderr.read())
+
+    async def finish() -> None:
+        await proc.wait()
+        stderr = await stderr_task
+        if proc.returncode != 0:
+            raise RuntimeError(f"yt-dlp завершился с кодом {proc.returncode}: {stderr.decode(errors='replace')[-500:]}")
+
+    in_flight: set[asyncio.Task] = set()
+    errors: list[BaseException] = []
+
+    def on_part_done(task: asyncio.Task) -> None:
+        in_flight.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+
+    try:
+        head: list[bytes] = []
+        while len(head) * MTPROTO_PART_SIZE < PYRO_MIN_SIZE:
+            part = await _read_part(proc.stdout)
+            if not head and part[4:8] != b"ftyp":
+                if not part:
+                    await finish()  # покажет stderr, если yt-dlp упал
+                    raise RuntimeError("yt-dlp ничего не выдал в stdout")
+                # ffmpeg не взял протокол, и yt-dlp отдал байты как есть — это не mp4
+                raise RuntimeError("yt-dlp выдал в stdout не mp4")
+            head.append(part)
+            if len(part) < MTPROTO_PART_SIZE:
+                await finish()
+                return b"".join(head)
+
+        file_id = pyro_client.rnd_id()
+        slots = asyncio.Semaphore(MTPROTO_PARALLEL_PARTS)
+
+        async def save_part(index: int, chunk: bytes, total: int) -> None:
+            try:
+                await pyro_client.invoke(
+                    raw.functions.upload.SaveBigFilePart(
+                        file_id=file_id, file_part=index, file_total_parts=total, bytes=chunk
+                    )
+                )
+            finally:
+                slots.release()
+
+        # Размер заранее неизвестен: все части, кроме последней, идут с total=-1,
+        # поэтому держим одну часть про запас, чтобы узнать, какая из них последняя
+        pending = deque(head)
+        eof = False
+        parts = 0
+        while pending:
+            # упавшая часть — бросаем сразу, а не после выкачивания всего потока
+            if errors:
+                raise errors[0]
+            chunk = pending.popleft()
+            if not pending and not eof:
+                nxt = await _read_part(proc.stdout)
+                eof = len(nxt) < MTPROTO_PART_SIZE
+                if nxt:
+                    pending.append(nxt)
+            await slots.acquire()
+            if errors:
+                raise errors[0]
+            total = -1 if pending else parts + 1
+            task = asyncio.create_task(save_part(parts, chunk, total))
+            in_flight.add(task)
+            task.add_done_callback(on_part_done)
+            parts += 1
+        await asyncio.gather(*in_flight)
+        await finish()
+    except BaseException:
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        if proc.returncode is None:
+            proc.kill()
+        # дочитываем stdout до EOF: пока pipe не закрыт, proc.wait() не вернётся
+        await proc.stdout.read()
+        await proc.wait()
+        await asyncio.gather(stderr_task, return_exceptions=True)
+        raise
+
+    info = info or {}
+    file_name = f"{info.get('id') or 'video'}.mp4"
+    await pyro_client.invoke(
+        raw.functions.messages.SendMedia(
+            peer=await pyro_client.resolve_peer(message.chat_id),
+            media=raw.types.InputMediaUploadedDocument(
+                file=raw.types.InputFileBig(id=file_id, parts=parts, name=file_name),
+                mime_type="video/mp4",
+                attributes=[
+                    raw.types.DocumentAttributeVideo(
+                        duration=int(info.get("duration") or 0),
+                        w=int(info.get("width") or 0),
+                        h=int(info.get("height") or 0),
+                        supports_streaming=True,
+                    ),
+                    raw.types.DocumentAttributeFilename(file_name=file_name),
+                ],
+            ),
+            message=caption,
+            random_id=pyro_client.rnd_id(),
+        )
+    )
+    return None
 
 # =================== Хранилище коротких callback ===================
-# context.user_data["dl_store"] = { token: {"url": str, "tmpdir": TemporaryDirectory} }
+# context.user_data["dl_store"] = OrderedDict{
+#     token: {"url": str, "info": dict | None,
+#             "format_ids": {height | None: "137+140"}, "created": float}
+# }  — в порядке создания, самые старые в начале. Папку под файл ("tmpdir")
+# заводит воркер скачивания: только тогда известен формат и его размер.
+
+MAX_JOBS_PER_USER = 50
+JOB_TTL = 30 * 60  # через сколько секунд невыбранная задача считается брошенной
+REAPER_INTERVAL = 5 * 60
+
+# Временные папки — в tmpfs (/dev/shm), если файл заведомо туда влезает: он не касается
+# диска ни при скачивании, ни при чтении на отправку. Размер проверяем для каждой задачи
+# по filesize из анализа; неизвестный или большой — на диск. DOWNLOAD_TMPDIR переопределяет.
+TMP_PREFIX = "atdl-"
+TMPFS_ROOT = "/dev/shm"
+TMPFS_MIN_FREE = 1024 * 1024 * 1024  # сколько tmpfs (то есть RAM) оставляем свободным
+TMPFS_MAX_FILE = 512 * 1024 * 1024
+TMP_OWNER_FILE = ".owner"  # "<hostname> <pid>" процесса-владельца папки
+STALE_TMPDIR_AGE = 6 * 60 * 60  # старше — точно брошена, даже если pid снова занят
+
+def estimate_size(info: dict | None, fmt: str | None) -> int | None:
+    """Размер выбранных format_id ("137+140/селектор") по данным анализа; None — неизвестен."""
+    if not info or not fmt:
+        return None
+    by_id = {f.get("format_id"): f for f in info.get("formats") or []}
+    total = 0
+    for fid in fmt.split("/")[0].split("+"):
+        f = by_id.get(fid)
+        size = f and (f.get("filesize") or f.get("filesize_approx"))
+        if not size:
+            return None
+        total += size
+    return total
+
+# Сколько байт tmpfs обещано задачам, которые ещё не дописали файл: без этого все
+# воркеры разом проходят проверку свободного места, пока никто ничего не записал
+tmpfs_reserved = 0
+
+def _pick_tmp_root(expected_size: int | None) -> str | None:
+    if os.getenv("DOWNLOAD_TMPDIR"):
+        return os.getenv("DOWNLOAD_TMPDIR")
+    if not expected_size or expected_size > TMPFS_MAX_FILE:
+        return None
+    try:
+        # x2: части видео/звука лежат рядом со склеенным файлом до конца мержа
+        free = shutil.disk_usage(TMPFS_ROOT).free - tmpfs_reserved
+        if free - 2 * expected_size >= TMPFS_MIN_FREE:
+            return TMPFS_ROOT
+    except OSError:
+        pass
+    return None
 
-def store_new_job(user_data: dict, url: str, tmpdir) -> str:
-    store: dict = user_data.setdefault("dl_store", {})
+def _drop_job(job: dict | None) -> None:
+    global tmpfs_reserved
+    if not job:
+        return
+    tmpfs_reserved -= job.pop("tmpfs_reserved", 0)
+    try:
+        if "tmpdir" in job:
+            job["tmpdir"].cleanup()
+    except Exception:
+        pass
+
+def _job_expired(job: dict, now: float) -> bool:
+    return now - job.get("created", 0.0) > JOB_TTL
+
+def _evict_expired(store: OrderedDict, now: float) -> None:
+    # протухшие задачи лежат в начале — снимаем, пока не дойдём до свежей
+    while store and _job_expired(next(iter(store.values())), now):
+        _drop_job(store.popitem(last=False)[1])
+    # после INFO_TTL info по скачиванию уже не используется — оставляем только id и название
+    for job in store.values():
+        if now - job.get("created", 0.0) < INFO_TTL:
+            break
+        info = job.get("info")
+        if info and "formats" in info:
+            job["info"] = {"id": info.get("id"), "title": info.get("title")}
+
+def store_new_job(
+    user_data: dict,
+    url: str,
+    info: dict | None = None,
+    format_ids: dict | None = None,
+) -> str:
+    store: OrderedDict = user_data.setdefault("dl_store", OrderedDict())
+    now = time.monotonic()
+    _evict_expired(store, now)
     token = secrets.token_urlsafe(8)
-    store[token] = {"url": url, "tmpdir": tmpdir}
-    # простая эвикция
-    if len(store) > 50:
-        for k in list(store.keys())[: len(store) - 50]:
-            job = store.pop(k, None)
-            try:
-                if job and "tmpdir" in job:
-                    job["tmpdir"].cleanup()
-            except Exception:
-                pass
+    store[token] = {"url": url, "info": info, "format_ids": format_ids or {}, "created": now}
+    # LRU-эвикция за O(1) на элемент
+    while len(store) > MAX_JOBS_PER_USER:
+        _drop_job(store.popitem(last=False)[1])
     return token
 
+def new_job_tmpdir(job: dict, expected_size: int | None = None) -> Path:
+    """Заводит job["tmpdir"]; место в tmpfs резервируется до _drop_job."""
+    global tmpfs_reserved
+    root = _pick_tmp_root(expected_size)
+    tmpdir = job["tmpdir"] = tempfile.TemporaryDirectory(prefix=TMP_PREFIX, dir=root)
+    if root == TMPFS_ROOT:
+        job["tmpfs_reserved"] = 2 * expected_size
+        tmpfs_reserved += job["tmpfs_reserved"]
+    (Path(tmpdir.name) / TMP_OWNER_FILE).write_text(f"{socket.gethostname()} {os.getpid()}")
+    return Path(tmpdir.name)
+
+def _owner_dead(owner_file: Path) -> bool:
+    """True, только если владелец папки точно не жив; при любом сомнении — False (решает возраст)."""
+    if os.name == "nt":
+        return False  # os.kill на Windows не проверяет процесс, а завершает его
+    try:
+        host, pid_text = owner_file.read_text().split()
+        pid = int(pid_text)
+    except (OSError, ValueError):
+        return False
+    if host != socket.gethostname():
+        return False  # другой хост/контейнер: его pid в нашем пространстве ничего не значат
+    if pid == os.getpid():
+        return True  # sweep идёт до первой задачи — это наш прошлый запуск с тем же pid
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False  # процесс есть, просто чужой
+    return False
+
+def sweep_stale_tmpdirs() -> None:
+    """Папки, брошенные упавшим процессом: их TemporaryDirectory уже никто не удалит.
+
+    Папки живых процессов (второй экземпляр бота, общий DOWNLOAD_TMPDIR) не трогаем:
+    удаляем только если владелец мёртв или папка старше STALE_TMPDIR_AGE.
+    """
+    roots = {os.getenv("DOWNLOAD_TMPDIR") or tempfile.gettempdir(), TMPFS_ROOT}
+    now = time.time()
+    for p in (p for root in roots for p in Path(root).glob(f"{TMP_PREFIX}*")):
+        try:
+            age = now - p.stat().st_mtime
+        except OSError:
+            continue
+        if _owner_dead(p / TMP_OWNER_FILE) or age > STALE_TMPDIR_AGE:
+            shutil.rmtree(p, ignore_errors=True)
+
+async def _reaper(app: Application) -> None:
+    # задачи тех, кто больше не пишет боту, иначе висели бы до следующей ссылки
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL)
+        now = time.monotonic()
+        for user_data in app.user_data.values():
+            store = user_data.get("dl_store")
+            if store:
+                _evict_expired(store, now)
+
 def pop_job(user_data: dict, token: str):
     store: dict = user_data.get("dl_store") or {}
-    return store.pop(token, None)
+    job = store.pop(token, None)
+    if job and _job_expired(job, time.monotonic()):
+        _drop_job(job)
+        return None
+    return job
 
 # =================== Handlers ===================
 
@@ -181,32 +705,37 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     status = await update.message.reply_text("🔎 Анализирую ссылку…")
 
-    tmpdir = tempfile.TemporaryDirectory()
-    tmp_path = Path(tmpdir.name)
-
     try:
-        info = await ytdlp_extract(url, download=False, fmt=None, target_dir=tmp_path)
+        async with user_ydl_slot(context.user_data):
+            info = await ytdlp_extract(
+                url, download=False, fmt=None, target_dir=None, base_opts=ANALYZE_YTDLP_OPTS
+            )
         if not info:
             await status.edit_text("❌ Не удалось получить информацию по ссылке. Возможно, она недоступна.")
-            tmpdir.cleanup()
             return
 
-        if "entries" in info and isinstance(info["entries"], list) and info["entries"]:
-            info = info["entries"][0]
+        # весь плейлист не качаем (noplaylist/playlist_items=1) — честно говорим об этом
+        playlist_note = ""
+        if info.get("_type") == "playlist":
+            playlist_note = "📃 Это плейлист — предлагаю только первое видео.\n"
+        info = single_entry(info)
 
         formats = info.get("formats") or []
         heights = unique_sorted_heights(formats)
         provider = human_provider(url)
         title = info.get("title") or "Видео"
 
-        token = store_new_job(context.user_data, url, tmpdir)
-
         buttons: list[list[InlineKeyboardButton]] = []
         wanted = [240, 360, 480, 720, 1080, 1440, 2160]
         display_heights = [h for h in wanted if h in heights]
         if not display_heights:
             display_heights = heights[-3:] if len(heights) > 3 else heights
 
+        # format_id под каждую кнопку считаем сразу: при скачивании yt-dlp не нужно
+        # заново разбирать селектор по всему списку форматов
+        format_ids = {h: pick_format_ids(formats, h) for h in (*display_heights, None)}
+        token = store_new_job(context.user_data, url, slim_info(info), format_ids)
+
         row: list[InlineKeyboardButton] = []
         for h in display_heights:
             row.append(InlineKeyboardButton(text=f"{h}p", callback_data=f"dl|{token}|h{h}"))
@@ -219,28 +748,31 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await status.edit_text(
             f"🌐 Источник: {provider}\n"
-            f"📄 Название: {title}\n\n"
+            f"📄 Название: {title}\n"
+            f"{playlist_note}\n"
             f"Выбери разрешение:",
             reply_markup=InlineKeyboardMarkup(buttons),
         )
     except Exception as e:
         logger.exception("Ошибка анализа")
         await status.edit_text(f"⚠️ Ошибка анализа ссылки: {e}")
-        tmpdir.cleanup()
 
-async def _send_with_retries_as_video_or_doc(message, file_path: Path, caption: str):
-    """Сначала пытаемся как video, при неудаче — как документ. Оба с ретраями на TimedOut."""
-    # показываем «печатаю» загрузку
-    try:
-        await message.chat.send_action(action=ChatAction.UPLOAD_VIDEO)
-    except Exception:
-        pass
+def _load_input_file(mm: mmap.mmap, filename: str) -> InputFile:
+    # InputFile вычитывает файл целиком в конструкторе — поэтому зовём его из потока
+    mm.seek(0)
+    return InputFile(mm, filename=filename)
+
+# После отправки тела Telegram (особенно локальный Bot API, который сам перезаливает
+# файл в ДЦ) может долго не отвечать; TimedOut тут привёл бы к повторной отправке
+MEDIA_READ_TIMEOUT = 600.0
 
+async def _reply_with_retries(message, load_input, caption: str):
+    """load_input — корутина-фабрика свежего InputFile (или пути в local mode) на каждую попытку."""
     # 1) как видео
     for attempt in range(3):
         try:
-            with file_path.open("rb") as f:
-                return await message.reply_video(video=InputFile(f, filename=file_path.name), caption=caption)
+            video = await load_input()
+            return await message.reply_video(video=video, caption=caption, read_timeout=MEDIA_READ_TIMEOUT)
         except TimedOut:
             if attempt == 2:
                 break
@@ -251,13 +783,70 @@ async def _send_with_retries_as_video_or_doc(message, file_path: Path, caption:
     # 2) как документ
     for attempt in range(3):
         try:
-            with file_path.open("rb") as f:
-                return await message.reply_document(document=InputFile(f, filename=file_path.name), caption=caption)
+            document = await load_input()
+            return await message.reply_document(
+                document=document, caption=caption, read_timeout=MEDIA_READ_TIMEOUT
+            )
         except TimedOut:
             if attempt == 2:
                 raise
             await asyncio.sleep(2 * (attempt + 1))
 
+async def _send_with_retries_as_video_or_doc(
+    message,
+    file_path: Path,
+    caption: str,
+    info: dict | None = None,
+    payload: bytes | None = None,
+):
+    """Сначала пытаемся как video, при неудаче — как документ. Оба с ретраями на TimedOut.
+
+    Если передан payload, файл уже в памяти, и file_path нужен только ради имени.
+    """
+    # показываем «печатаю» загрузку
+    try:
+        await message.chat.send_action(action=ChatAction.UPLOAD_VIDEO)
+    except Exception:
+        pass
+
+    size = len(payload) if payload is not None else file_path.stat().st_size
+
+    # 0) большие файлы — через MTProto: pyrogram грузит части параллельно
+    if pyro_client is not None and size >= PYRO_MIN_SIZE:
+        info = info or {}
+        try:
+            return await pyro_client.send_video(
+                message.chat_id,
+                io.BytesIO(payload) if payload is not None else str(file_path),
+                caption=caption,
+                file_name=file_path.name,
+                duration=int(info.get("duration") or 0),
+                width=int(info.get("width") or 0),
+                height=int(info.get("height") or 0),
+            )
+        except Exception:
+            logger.warning("Не удалось отправить через MTProto, пробую Bot API", exc_info=True)
+
+    if payload is not None:
+        async def load_payload() -> InputFile:
+            return InputFile(payload, filename=file_path.name)
+
+        return await _reply_with_retries(message, load_payload, caption)
+
+    if TELEGRAM_BASE_URL:
+        # local mode: серверу уходит file:// путь, файл он читает с диска сам —
+        # не копируем его целиком в bytes ради multipart
+        async def load_path() -> Path:
+            return file_path
+
+        return await _reply_with_retries(message, load_path, caption)
+
+    # файл мапим один раз: ретраи читают страницы из page cache, а не с диска заново
+    with file_path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return await _reply_with_retries(
+            message, lambda: asyncio.to_thread(_load_input_file, mm, file_path.name), caption
+        )
+
 async def on_download_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     if not query:
@@ -276,14 +865,8 @@ async def on_download_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     url = job.get("url")
-    tmpdir = job.get("tmpdir")
-    if not url or not tmpdir:
+    if not url:
         await query.edit_message_text("Внутренняя ошибка: нет данных задачи.")
-        try:
-            if tmpdir:
-                tmpdir.cleanup()
-        except Exception:
-            pass
         return
 
     chosen_height: int | None
@@ -297,60 +880,206 @@ async def on_download_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
     else:
         chosen_height = None
 
-    provider = human_provider(url)
-    await query.edit_message_text(f"⬇️ Скачиваю из {provider}…")
+    job["query"] = query
+    job["height"] = chosen_height
+    # точный format_id из анализа; селектор — запасной вариант, если сайт пришлось извлекать заново
+    format_id = job.get("format_ids", {}).get(chosen_height)
+    fallback = build_format_string(chosen_height)
+    job["fmt"] = f"{format_id}/{fallback}" if format_id else fallback
+    job["slot"] = user_ydl_slot(context.user_data)
+    await query.edit_message_text("🕒 Задача в очереди…")
+    # слот пользователя берём до постановки в очередь (отпускает воркер после скачивания),
+    # чтобы воркеры не простаивали в ожидании чужого лимита
+    await job["slot"].acquire()
+    await download_queue.put(job)
+
+# =================== Очереди скачивания/отправки ===================
+# Скачивание и отправка разнесены по разным воркерам: пока один файл
+# медленно уходит в Telegram, поток yt-dlp уже качает следующий.
+
+DOWNLOAD_WORKERS = YDL_WORKERS
+UPLOAD_WORKERS = 4
 
-    tmp_path = Path(tmpdir.name)
+download_queue: asyncio.Queue = asyncio.Queue()
+upload_queue: asyncio.Queue = asyncio.Queue()
+
+async def _download_job(job: dict) -> None:
+    query = job["query"]
+    url = job["url"]
+    handed_off = False
 
     try:
-        fmt = build_format_string(chosen_height)
-        info = await ytdlp_extract(url, download=True, fmt=fmt, target_dir=tmp_path)
+        await query.edit_message_text(f"⬇️ Скачиваю из {human_provider(url)}…")
+
+        fmt = job["fmt"]
+        info = None
+        cached = job.get("info")
+        fresh = bool(cached) and time.monotonic() - job.get("created", 0.0) < INFO_TTL
+        tmp_path = new_job_tmpdir(job, estimate_size(cached, fmt))
+
+        # короткий цельный клип — сразу в память, без записи на диск и повторного чтения
+        stream_fmt = pick_stream_format(cached, job.get("height")) if fresh else None
+        if stream_fmt:
+            payload = None
+            try:
+                payload = await fetch_to_memory(stream_fmt)
+            except Exception:
+                logger.warning("Не удалось скачать в память, качаю через yt-dlp", exc_info=True)
+            if payload:
+                job["payload"] = payload
+                job["file_path"] = tmp_path / f"{cached.get('id') or 'video'}.{stream_fmt['ext']}"
+                await upload_queue.put(job)
+                handed_off = True
+                return
+
+        # с MTProto файл вообще не ложится на диск: stdout yt-dlp сразу уходит частями в Telegram
+        if pyro_client is not None:
+            caption = ((cached or {}).get("title") or "Видео")[:900]
+            try:
+                payload = await stream_to_mtproto(
+                    query.message, url, fmt, cached if fresh else None, tmp_path, caption
+                )
+            except Exception:
+                logger.warning("Потоковая отправка через MTProto не удалась, качаю на диск", exc_info=True)
+            else:
+                if payload is None:
+                    await query.edit_message_text("✅ Готово!")
+                    return
+                job["payload"] = payload
+                job["file_path"] = tmp_path / f"{(cached or {}).get('id') or 'video'}.mp4"
+                await upload_queue.put(job)
+                handed_off = True
+                return
+
+        if fresh:
+            try:
+                info = await ytdlp_extract(url, download=True, fmt=fmt, target_dir=tmp_path, info=cached)
+            except (DownloadError, ExtractorError):
+                logger.warning("Не удалось скачать по сохранённому info, извлекаю заново", exc_info=True)
+        if not info:
+            info = await ytdlp_extract(url, download=True, fmt=fmt, target_dir=tmp_path)
         if not info:
             await query.edit_message_text("❌ Не удалось скачать видео (нет данных).")
             return
 
-        if "entries" in info and isinstance(info["entries"], list) and info["entries"]:
-            info = info["entries"][0]
+        info = single_entry(info)
 
-        media_id = info.get("id") or info.get("display_id") or ""
-        file_path = pick_filename_from_dir(tmp_path, media_id)
+        file_path = downloaded_file_path(info, tmp_path)
         if not file_path or not file_path.exists():
             await query.edit_message_text("❌ Не удалось найти скачанный файл. Возможно, источник ограничен.")
             return
 
-        caption = (info.get("title") or "Видео")[:900]
-
-        try:
-            await _send_with_retries_as_video_or_doc(query.message, file_path, caption)
-            await query.edit_message_text("✅ Готово!")
-        except Exception as e_send:
-            logger.exception("Ошибка отправки")
-            await query.edit_message_text(f"⚠️ Не удалось отправить файл: {e_send}")
+        job["info"] = info
+        job["file_path"] = file_path
+        await upload_queue.put(job)
+        handed_off = True
 
     except Exception as e:
-        logger.exception("Ошибка скачивания/отправки")
+        logger.exception("Ошибка скачивания")
         try:
-            await query.edit_message_text(f"⚠️ Не удалось скачать/отправить: {e}")
+            await query.edit_message_text(f"⚠️ Не удалось скачать: {e}")
         except Exception:
             pass
     finally:
+        job["slot"].release()
+        if not handed_off:
+            _drop_job(job)
+
+async def _upload_job(job: dict) -> None:
+    query = job["query"]
+    info = job["info"]
+    caption = (info.get("title") or "Видео")[:900]
+
+    try:
+        await _send_with_retries_as_video_or_doc(
+            query.message, job["file_path"], caption, info, payload=job.get("payload")
+        )
+        await query.edit_message_text("✅ Готово!")
+    except Exception as e_send:
+        logger.exception("Ошибка отправки")
         try:
-            tmpdir.cleanup()
+            await query.edit_message_text(f"⚠️ Не удалось отправить файл: {e_send}")
         except Exception:
             pass
+    finally:
+        _drop_job(job)
+
+async def _queue_worker(queue: asyncio.Queue, handle) -> None:
+    while True:
+        job = await queue.get()
+        try:
+            await handle(job)
+        except Exception:
+            logger.exception("Ошибка воркера очереди")
+        finally:
+            queue.task_done()
 
 # =================== Запуск (Python 3.14) ===================
 
+async def on_startup(app: Application) -> None:
+    global pyro_client
+    sweep_stale_tmpdirs()
+    app.bot_data["workers"] = [
+        *(asyncio.create_task(_queue_worker(download_queue, _download_job)) for _ in range(DOWNLOAD_WORKERS)),
+        *(asyncio.create_task(_queue_worker(upload_queue, _upload_job)) for _ in range(UPLOAD_WORKERS)),
+        asyncio.create_task(_reaper(app)),
+    ]
+
+    client = build_pyro_client()
+    if client is None:
+        return
+    try:
+        await client.start()
+    except Exception:
+        logger.exception("Не удалось запустить MTProto-клиент — отправляю через Bot API")
+        return
+    pyro_client = client
+
+async def on_shutdown(app: Application) -> None:
+    global pyro_client
+    workers = app.bot_data.pop("workers", [])
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    if pyro_client is not None:
+        try:
+            await pyro_client.stop()
+        except Exception:
+            pass
+        pyro_client = None
+    YDL_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
 def build_app() -> Application:
-    # Большие таймауты, чтобы аплоад не упирался в write timeout
+    # Большие таймауты, чтобы аплоад не упирался в write timeout.
+    # С локальным Bot API файл уходит на localhost — хватает минуты.
+    write_timeout = 60.0 if TELEGRAM_BASE_URL else 600.0
+    # HTTP/2: все исходящие вызовы мультиплексируются поверх одного соединения;
+    # пула хватает на getUpdates + параллельные отправки всех воркеров.
+    # Локальный Bot API сервер умеет только HTTP/1.1.
     request = HTTPXRequest(
-        connect_timeout=30.0,
-        read_timeout=600.0,
-        write_timeout=600.0,
-        pool_timeout=30.0,
+        http_version="1.1" if TELEGRAM_BASE_URL else "2",
+        connection_pool_size=max(32, 2 * (DOWNLOAD_WORKERS + UPLOAD_WORKERS)),
+        connect_timeout=10.0,
+        read_timeout=120.0,
+        write_timeout=write_timeout,
+        media_write_timeout=write_timeout,
+        pool_timeout=5.0,
     )
 
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).request(request).build()
+    # concurrent_updates: иначе PTB обрабатывает апдейты строго по одному,
+    # и пул YDL_EXECUTOR простаивал бы
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .request(request)
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL).base_file_url(TELEGRAM_BASE_FILE_URL).local_mode(True)
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
@@ -365,7 +1094,10 @@ def main():
     asyncio.set_event_loop(loop)
 
     app = build_app()
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        log_listener.stop()  # дописываем всё, что осталось в очереди
 
 if __name__ == "__main__":
     main()